@@ -1,42 +1,55 @@
 # marketing_bot.py — STRIGI_KAPUSTU_BOT (полная версия)
 
-import os, logging, re, json
+import os, logging, re, json, time, asyncio, functools, threading, dataclasses, hashlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Callable, Dict, Any, Iterator, List, NamedTuple, Optional, Tuple
 
 import gspread
 from gspread.utils import rowcol_to_a1
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from telegram import (
     Update, constants, BotCommand,
     BotCommandScopeChat, BotCommandScopeAllPrivateChats
 )
 from telegram.ext import (
     ApplicationBuilder, Application, CommandHandler,
-    ContextTypes
+    ContextTypes, AIORateLimiter
 )
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
 
 # ------------------- ENV -------------------
 BOT_NAME = "STRIGI_KAPUSTU_BOT"
 BOT_TOKEN = os.getenv("MARKETING_BOT_TOKEN")
 SHEET_ID = os.getenv("SHEET_ID")
 
+_ADMIN_SPLIT = re.compile(r'[\s,;]+')
+_INT_RE = re.compile(r'-?\d+')
+
 def parse_admin_ids(raw: str) -> set[int]:
     if not raw: return set()
     try:
         maybe = json.loads(raw)
         if isinstance(maybe, (list, tuple, set)): return {int(x) for x in maybe}
-        if isinstance(maybe, (int, str)) and str(maybe).lstrip("-").isdigit(): return {int(maybe)}
+        if isinstance(maybe, (int, str)) and _INT_RE.fullmatch(str(maybe)): return {int(maybe)}
     except Exception:
         pass
     out = set()
-    for t in re.split(r'[\s,;]+', raw.strip()):
+    for t in _ADMIN_SPLIT.split(raw.strip()):
         t = t.strip().strip('[](){}"\'')
-        if t and (t.lstrip("-").isdigit()):
+        if _INT_RE.fullmatch(t):
             out.add(int(t))
     return out
 
-ADMIN_IDS = parse_admin_ids(os.getenv("ADMIN_IDS", ""))
+ADMIN_IDS = frozenset(parse_admin_ids(os.getenv("ADMIN_IDS", "")))
 SYSTEM_BANK_USDT = float(os.getenv("SYSTEM_BANK_USDT", "1000"))
+# webhook вместо getUpdates: задан публичный https-адрес — Telegram сам пушит апдейты
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or "").rstrip("/")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"secret:{BOT_TOKEN}".encode()).hexdigest()[:32]
 
 if not BOT_TOKEN or not SHEET_ID or not ADMIN_IDS:
     raise RuntimeError("MARKETING_BOT_TOKEN / SHEET_ID / ADMIN_IDS обязательны")
@@ -45,9 +58,7 @@ def now_utc_str() -> str:
     return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
 
 # ------------------- LOG -------------------
-log = logging.getLogger("marketing")
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
-log.info(f"ADMIN_IDS parsed={sorted(ADMIN_IDS)}")
+log = logging.getLogger("marketing")  # handlers/формат настраивает main(), при импорте модуль root не трогает
 
 # ------------------- Меню команд -------------------
 USER_COMMANDS = [
@@ -86,11 +97,14 @@ async def set_menu_user(app: Application, chat_id: int):
     await app.bot.set_my_commands(USER_COMMANDS, scope=BotCommandScopeChat(chat_id))
 
 async def set_menu_admins(app: Application):
-    for aid in ADMIN_IDS:
-        try:
-            await app.bot.set_my_commands(ADMIN_COMMANDS, scope=BotCommandScopeChat(aid))
-        except Exception as e:
-            log.error(f"Failed to set menu for admin {aid}: {e}")
+    admins = list(ADMIN_IDS)
+    results = await asyncio.gather(
+        *(app.bot.set_my_commands(ADMIN_COMMANDS, scope=BotCommandScopeChat(aid)) for aid in admins),
+        return_exceptions=True,
+    )
+    for aid, res in zip(admins, results):
+        if isinstance(res, Exception):
+            log.error("Failed to set menu for admin %s: %s", aid, res)
 
 # ------------------- Sheets -------------------
 CREDS_JSON = os.getenv("GOOGLE_CREDENTIALS")
@@ -98,8 +112,27 @@ if not CREDS_JSON:
     raise RuntimeError("GOOGLE_CREDENTIALS env var not set")
 
 gc = gspread.service_account_from_dict(json.loads(CREDS_JSON))
+# общий пул keep-alive соединений к Sheets API + ретраи идемпотентных запросов на 429/5xx
+gc.session.mount("https://", HTTPAdapter(
+    pool_connections=10, pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False),
+))
 sh = gc.open_by_key(SHEET_ID)
 
+# gspread синхронный: вызовы Sheets уходят в пул потоков, event loop не блокируется.
+# Операции над кэшем пользователей/State идут под SHEET_LOCK (read-modify-write атомарны,
+# как было в однопоточной версии); запись Ledger этот кэш не трогает и идёт без лока.
+SHEET_EXEC = ThreadPoolExecutor(max_workers=8, thread_name_prefix="gs")
+SHEET_LOCK = threading.RLock()
+
+def _locked(fn, *a, **kw):
+    with SHEET_LOCK:
+        return fn(*a, **kw)
+
+async def sh_run(fn, *a, locked: bool = True, **kw):
+    call = functools.partial(_locked, fn, *a, **kw) if locked else functools.partial(fn, *a, **kw)
+    return await asyncio.get_running_loop().run_in_executor(SHEET_EXEC, call)
+
 LOG_SHEET    = "BMR_DCA_Log"
 USERS_SHEET = "Marketing_Users"
 STATE_SHEET = "Marketing_State"
@@ -113,24 +146,38 @@ USERS_HEADERS = [
     "Wallet_Pending_Address","Wallet_Pending_Network",
     "Wallet_Updated_UTC","Last_Update"
 ]
-STATE_HEADERS = ["Last_Row","Start_UTC","Profit30_Total_USDT"]
+STATE_HEADERS = ["Last_Row","Start_UTC","Profit30_Total_USDT","Open_Positions"]
 LEDGER_HEADERS = [
     "Timestamp_UTC","Type","Chat_ID","Name","Amount_USDT","Note","Admin",
     "Signal_ID","Tx_Direction","Old_Address","Old_Network","New_Address","New_Network","Status"
 ]
 
 # ------------- helpers -------------
+_NUM_TT = str.maketrans({" ": "", "\xa0": "", ",": "."})
+
 def to_float(x) -> float:
+    if isinstance(x, (int, float)) and not isinstance(x, bool):
+        return float(x)  # UNFORMATTED_VALUE: число пришло числом, разбирать нечего
+    s = str(x).translate(_NUM_TT).strip() if x is not None else ""
+    if not s:
+        return 0.0
     try:
-        return float(str(x).replace(",", ".").strip())
-    except (ValueError, TypeError):
+        return float(s)
+    except ValueError:
         return 0.0
 
+def to_text(x) -> str:
+    # с UNFORMATTED_VALUE ячейка может прийти числом/булевым (Signal_ID, Name и т.п.)
+    return "" if x is None else str(x).strip()
+
+_MONEY_STRIP = re.compile(r"[^\d.,\-]")
+_SETDEP_RE = re.compile(r"^/setdep\s+(-?\d+)\s+([0-9][\d\s.,]*)\s*$", re.I)
+
 def parse_money(s: str) -> float:
     s = (s or "").strip()
     if s.lower() == "all":
         return float("nan")  # спец-значение: "all"
-    return float(re.sub(r"[^\d.,\-]", "", s).replace(",", "."))
+    return float(_MONEY_STRIP.sub("", s).replace(",", "."))
 
 def fmt_usd(x) -> str:
     try:
@@ -140,35 +187,96 @@ def fmt_usd(x) -> str:
     return f"{v:,.2f}".replace(",", " ")
 
 def is_admin(update: Update) -> bool:
-    uid = update.effective_user.id if update.effective_user else None
-    cid = update.effective_chat.id if update.effective_chat else None
-    return (uid in ADMIN_IDS) or (cid in ADMIN_IDS)
+    user, chat = update.effective_user, update.effective_chat
+    return bool((user and user.id in ADMIN_IDS) or (chat and chat.id in ADMIN_IDS))
 
+@functools.lru_cache(maxsize=128)
 def base_from_pair(pair: str) -> str:
     base = (pair or "").split("/")[0].split(":")[0].upper()
     return base[:-1] if base.endswith("C") and len(base) > 3 else base
 
-def sheet_dicts(worksheet) -> List[Dict[str, Any]]:
-    vals = worksheet.get_all_values()
-    if not vals or len(vals) < 2:
-        return []
-    headers, out = vals[0], []
-    for row in vals[1:]:
-        out.append({headers[i]: (row[i] if i < len(row) else "") for i in range(len(headers))})
-    return out
+# хэндлы листов: все разом одним sh.worksheets(), дальше — без запросов метаданных
+_WS: Dict[str, gspread.Worksheet] = {}
+
+def _load_worksheets():
+    _WS.update({w.title: w for w in sh.worksheets()})
+
+def ws(title: str) -> gspread.Worksheet:
+    if title not in _WS:
+        _load_worksheets()
+        if title not in _WS:
+            _WS[title] = sh.worksheet(title)  # нет такого листа -> WorksheetNotFound
+    return _WS[title]
+
+@functools.lru_cache(maxsize=16)
+def _headers(title: str) -> Tuple[str, ...]:
+    return tuple(ws(title).row_values(1))
+
+# ------------- кэш значений листов -------------
+# числа — числами (без локального форматирования), даты — как в таблице
+READ_PARAMS = {"valueRenderOption": "UNFORMATTED_VALUE", "dateTimeRenderOption": "FORMATTED_STRING"}
 
-def ws(title): return sh.worksheet(title)
+class SheetCache:
+    """title -> (headers, rows, fetched_ts); листы читаются одним values.batchGet, свежие — не перечитываются."""
 
-def ensure_headers(ws_title: str, required: list[str]):
-    names = {w.title for w in sh.worksheets()}
-    if ws_title not in names:
+    def __init__(self):
+        self._data: Dict[str, Tuple[List[str], List[List[Any]], float]] = {}
+
+    def load(self, titles: List[str]):
+        resp = sh.values_batch_get(list(titles), params=READ_PARAMS)
+        for title, vr in zip(titles, resp.get("valueRanges", [])):
+            vals = vr.get("values", [])
+            self._data[title] = ([to_text(h) for h in vals[0]] if vals else [], vals[1:], time.monotonic())
+
+    def get(self, title: str) -> Tuple[List[str], List[List[Any]]]:
+        if title not in self._data:
+            self.load([title])
+        headers, rows, _ = self._data[title]
+        return headers, rows
+
+    def load_stale(self, titles: List[str], ttl: float):
+        now = time.monotonic()
+        stale = [t for t in titles if t not in self._data or now - self._data[t][2] >= ttl]
+        if stale:
+            self.load(stale)
+
+    def fetched_at(self, title: str) -> Optional[float]:
+        entry = self._data.get(title)
+        return entry[2] if entry else None
+
+    def put_row(self, title: str, idx: int, row: List[Any]):
+        """Записали строку сами — правим кэш на месте, без перечитывания (idx — номер строки данных с 0)."""
+        headers, rows, ts = self._data.get(title, ([], [], time.monotonic()))
+        rows = rows + [[] for _ in range(idx + 1 - len(rows))]
+        rows[idx] = row
+        self._data[title] = (headers, rows, ts)
+
+    def invalidate(self, title: str):
+        self._data.pop(title, None)
+
+sheet_cache = SheetCache()
+
+_HEADERS_OK: set[str] = set()  # листы, чьи заголовки уже проверены в этом процессе
+
+def ensure_headers(ws_title: str, required: list[str], existing: Optional[List[str]] = None):
+    if ws_title in _HEADERS_OK:
+        return
+    _ensure_headers(ws_title, required, existing)
+    _HEADERS_OK.add(ws_title)
+
+def _ensure_headers(ws_title: str, required: list[str], existing: Optional[List[str]] = None):
+    """existing — уже прочитанная строка заголовков (None — прочитаем сами)."""
+    if not _WS:
+        _load_worksheets()
+    if ws_title not in _WS:
         ws_new = sh.add_worksheet(ws_title, rows=200, cols=max(10, len(required)))
         ws_new.update("A1", [required])  # якорная запись, без правого края
+        _WS[ws_title] = ws_new
         return
 
     w = ws(ws_title)
-    vals = w.get_all_values()
-    existing = vals[0] if vals else []
+    if existing is None:
+        existing = w.row_values(1)
     if not existing:
         w.update("A1", [required])
         return
@@ -177,6 +285,7 @@ def ensure_headers(ws_title: str, required: list[str]):
     if not missing:
         return
 
+    vals = w.get_all_values()  # весь лист — только когда колонки действительно добавляем
     new_headers = existing + missing
 
     # гарантируем достаточное число колонок
@@ -190,6 +299,7 @@ def ensure_headers(ws_title: str, required: list[str]):
 
     # 1) Перезаписываем строку заголовков с A1 (без правой границы)
     w.update("A1", [new_headers])
+    _headers.cache_clear()
 
     # 2) Добиваем пустые ячейки под новые колонки для остальных строк (если есть)
     if len(vals) > 1 and len(missing) > 0:
@@ -199,80 +309,194 @@ def ensure_headers(ws_title: str, required: list[str]):
         w.update(f"{start}:{end}", blanks)
 
 def ensure_sheets():
-    ensure_headers(USERS_SHEET, USERS_HEADERS)
-    ensure_headers(STATE_SHEET, STATE_HEADERS)
-    ensure_headers(LEDGER_SHEET, LEDGER_HEADERS)
-    names = {w.title for w in sh.worksheets()}
-    if LOG_SHEET not in names:
+    _load_worksheets()
+    # заголовки существующих листов + строка State — одним values.batchGet
+    titles = [t for t in (USERS_SHEET, STATE_SHEET, LEDGER_SHEET) if t in _WS]
+    resp = sh.values_batch_get([f"{t}!1:2" if t == STATE_SHEET else f"{t}!1:1" for t in titles]) if titles else {}
+    top = {t: vr.get("values", []) for t, vr in zip(titles, resp.get("valueRanges", []))}
+    for title, required in ((USERS_SHEET, USERS_HEADERS), (STATE_SHEET, STATE_HEADERS), (LEDGER_SHEET, LEDGER_HEADERS)):
+        vals = top.get(title)  # None — листа нет, создаст ensure_headers
+        ensure_headers(title, required, None if vals is None else (vals[0] if vals else []))
+    if LOG_SHEET not in _WS:
         raise RuntimeError(f"Не найден лист {LOG_SHEET} (его пишет основной бот)")
     # init state defaults
     wst = ws(STATE_SHEET)
-    vals = wst.get_all_values()
-    if len(vals) < 2:
+    vals = top.get(STATE_SHEET, [])[1:2]  # строка State уже прочитана вместе с заголовком
+    row = (vals[0] if vals else []) + ["", "", ""]
+    if not vals:
         wst.update("A2:C2", [["0", now_utc_str(), "0"]])
-    else:
-        if not (wst.acell("B2").value or "").strip():
-            wst.update_acell("B2", now_utc_str())
-        if not (wst.acell("C2").value or "").strip():
-            wst.update_acell("C2", "0")
-
-ensure_sheets()
+    elif not row[1].strip() or not row[2].strip():
+        wst.update("B2:C2", [[row[1].strip() or now_utc_str(), row[2].strip() or "0"]])
 
 # ------------ CRUD users/state/ledger ------------
 def get_state() -> Tuple[int, str, float]:
-    w = ws(STATE_SHEET)
-    a, b, c = w.acell("A2").value, w.acell("B2").value, w.acell("C2").value
-    last_row = int(a) if (a or "").strip().isdigit() else 0
-    start_utc = b or now_utc_str()
+    _, rows = sheet_cache.get(STATE_SHEET)
+    row = (rows[0] if rows else []) + ["", "", ""]
+    a, b, c = row[0], row[1], row[2]
+    last_row = max(int(to_float(a)), 0)
+    start_utc = to_text(b) or now_utc_str()
     profit30_total = to_float(c)
     return last_row, start_utc, profit30_total
 
-def set_state(last_row: Optional[int] = None, profit30_total: Optional[float] = None, start_utc: Optional[str] = None):
-    w = ws(STATE_SHEET)
-    if last_row is not None: w.update_acell("A2", str(last_row))
-    if start_utc is not None: w.update_acell("B2", start_utc)
-    if profit30_total is not None: w.update_acell("C2", str(profit30_total))
-
-def get_users() -> List[Dict[str, Any]]:
-    vals = ws(USERS_SHEET).get_all_records()
-    res = []
-    for r in vals:
+def get_open_positions_json() -> str:
+    _, rows = sheet_cache.get(STATE_SHEET)
+    row = (rows[0] if rows else []) + ["", "", "", ""]
+    return to_text(row[3])
+
+def state_batch_data(last_row: Optional[int] = None, profit30_total: Optional[float] = None, start_utc: Optional[str] = None,
+                     positions_json: Optional[str] = None) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Диапазоны values.batchUpdate для изменившихся ячеек State!A2:D2 и новая строка для кэша (кэш не трогает)."""
+    _, rows = sheet_cache.get(STATE_SHEET)
+    row = [to_text(v) for v in (rows[0] if rows else [])] + [""] * 4
+    new = [str(v) if v is not None else row[i] for i, v in enumerate((last_row, start_utc, profit30_total, positions_json))]
+    data = [
+        {"range": f"{STATE_SHEET}!{rowcol_to_a1(2, i + 1)}", "values": [[v]]}
+        for i, v in enumerate(new) if v != row[i]
+    ]
+    return data, new
+
+def set_state(last_row: Optional[int] = None, profit30_total: Optional[float] = None, start_utc: Optional[str] = None,
+              positions_json: Optional[str] = None):
+    # пишем только изменившиеся ячейки — и одной записью values.batchUpdate
+    data, new = state_batch_data(last_row, profit30_total, start_utc, positions_json)
+    if not data:
+        return
+    sh.values_batch_update(body={"valueInputOption": "RAW", "data": data})
+    sheet_cache.put_row(STATE_SHEET, 0, new)
+
+@dataclass(slots=True)
+class User:
+    chat_id: int
+    name: str = ""
+    deposit: float = 0.0
+    active: bool = True
+    pending: float = 0.0
+    bonus_acc: float = 0.0
+    bonus_paid: float = 0.0
+    bonus_to_dep: float = 0.0
+    w_addr: str = ""
+    w_net: str = ""
+    w_p_addr: str = ""
+    w_p_net: str = ""
+    updated: str = ""
+
+# Кэш пользователей: chat_id -> user, chat_id -> номер строки. Пересобирается,
+# когда SheetCache перечитал лист (раз в цикл опроса); записи правят его на месте.
+# Правки листа руками подхватываются не позже чем через USERS_TTL, даже если опрос стоит.
+USERS_TTL = 30.0
+USERS: Dict[int, User] = {}
+ROW_INDEX: Dict[int, int] = {}
+_users_src_ts: Optional[float] = None
+
+def refresh_users_cache():
+    global _users_src_ts
+    headers, rows = sheet_cache.get(USERS_SHEET)
+    USERS.clear(); ROW_INDEX.clear()
+    # индексы колонок — один раз на лист, строки не превращаем в dict
+    col = {h: i for i, h in enumerate(headers)}
+    def cell(row, h, missing=""):
+        i = col.get(h)
+        if i is None:
+            return missing
+        return row[i] if i < len(row) else ""
+    for row_idx, row in enumerate(rows, start=2):
         try:
-            res.append({
-                "chat_id": int(r.get("Chat_ID")),
-                "name": r.get("Name") or "",
-                "deposit": to_float(r.get("Deposit_USDT")),
-                "active": str(r.get("Active", "TRUE")).strip().upper() not in ("FALSE", "0", ""),
-                "pending": to_float(r.get("Pending_Deposit")),
-                "bonus_acc": to_float(r.get("Bonus_Accrued")),
-                "bonus_paid": to_float(r.get("Bonus_Paid")),
-                "bonus_to_dep": to_float(r.get("Bonus_To_Deposit")),
-                "w_addr": (r.get("Wallet_Address") or "").strip(),
-                "w_net": (r.get("Wallet_Network") or "").strip().upper(),
-                "w_p_addr": (r.get("Wallet_Pending_Address") or "").strip(),
-                "w_p_net": (r.get("Wallet_Pending_Network") or "").strip().upper(),
-                "updated": (r.get("Last_Update") or "").strip(),
-            })
+            u = User(
+                chat_id=int(cell(row, "Chat_ID")),
+                name=to_text(cell(row, "Name")),
+                deposit=to_float(cell(row, "Deposit_USDT")),
+                active=str(cell(row, "Active", "TRUE")).strip().upper() not in ("FALSE", "0", ""),
+                pending=to_float(cell(row, "Pending_Deposit")),
+                bonus_acc=to_float(cell(row, "Bonus_Accrued")),
+                bonus_paid=to_float(cell(row, "Bonus_Paid")),
+                bonus_to_dep=to_float(cell(row, "Bonus_To_Deposit")),
+                w_addr=to_text(cell(row, "Wallet_Address")),
+                w_net=to_text(cell(row, "Wallet_Network")).upper(),
+                w_p_addr=to_text(cell(row, "Wallet_Pending_Address")),
+                w_p_net=to_text(cell(row, "Wallet_Pending_Network")).upper(),
+                updated=to_text(cell(row, "Last_Update")),
+            )
         except Exception as e:
-            log.warning(f"Skipping invalid user row: {r} err={e}")
-    return res
+            log.warning("Skipping invalid user row %s: %s err=%s", row_idx, row, e)
+            continue
+        if u.chat_id not in USERS:  # дубликаты: как и find(), берём первую строку
+            USERS[u.chat_id] = u
+            ROW_INDEX[u.chat_id] = row_idx
+    _users_src_ts = sheet_cache.fetched_at(USERS_SHEET)
+
+def _ensure_users():
+    if _users_src_ts is not None and time.monotonic() - _users_src_ts > USERS_TTL:
+        sheet_cache.invalidate(USERS_SHEET)
+    if _users_src_ts is None or sheet_cache.fetched_at(USERS_SHEET) != _users_src_ts:
+        refresh_users_cache()
+
+# Наружу отдаём копии: хендлеры читают старые значения и после upsert_user_row.
+def get_users() -> List[User]:
+    _ensure_users()
+    return [dataclasses.replace(u) for u in USERS.values()]
+
+def find_user(chat_id: int) -> Optional[User]:
+    _ensure_users()
+    u = USERS.get(chat_id)
+    return dataclasses.replace(u) if u else None
 
 def find_user_row_idx(chat_id: int) -> Optional[int]:
-    w = ws(USERS_SHEET)
-    try:
-        cell = w.find(str(chat_id), in_column=1)
-        if cell: return cell.row
-    except Exception:
-        pass
-    # fallback
-    try:
-        col = w.col_values(1)
-        for i, v in enumerate(col, start=1):
-            if str(v).strip() == str(chat_id):
-                return i
-    except Exception:
-        pass
-    return None
+    _ensure_users()
+    return ROW_INDEX.get(chat_id)
+
+# поле кэша пользователя -> колонка в USERS_SHEET
+USER_FIELDS = {
+    "name": "Name", "deposit": "Deposit_USDT", "active": "Active", "pending": "Pending_Deposit",
+    "bonus_acc": "Bonus_Accrued", "bonus_paid": "Bonus_Paid", "bonus_to_dep": "Bonus_To_Deposit",
+    "w_addr": "Wallet_Address", "w_net": "Wallet_Network",
+    "w_p_addr": "Wallet_Pending_Address", "w_p_net": "Wallet_Pending_Network",
+}
+
+def _cell_str(v) -> str:
+    if isinstance(v, bool): return "TRUE" if v else "FALSE"
+    return str(v)
+
+def users_batch_data(changes: Dict[int, Dict[str, Any]], now: str) -> Tuple[List[Dict[str, Any]], Dict[int, Dict[str, Any]]]:
+    """Диапазоны values.batchUpdate для полей, отличающихся от кэша USERS (+ Last_Update), и сами отличия
+    для apply_users_changes — кэш не трогает."""
+    headers, _ = sheet_cache.get(USERS_SHEET)
+    col = {h: i + 1 for i, h in enumerate(headers)}
+    data, applied = [], {}
+    for chat_id, fields in changes.items():
+        u, row_idx = USERS.get(chat_id), ROW_INDEX.get(chat_id)
+        if u is None or row_idx is None:
+            continue
+        changed = {k: v for k, v in fields.items() if v is not None and getattr(u, k) != v}
+        if not changed:
+            continue
+        cells = {USER_FIELDS[k]: _cell_str(v) for k, v in changed.items()}
+        cells["Last_Update"] = now
+        data += [
+            {"range": f"{USERS_SHEET}!{rowcol_to_a1(row_idx, col[h])}", "values": [[v]]}
+            for h, v in cells.items() if h in col
+        ]
+        applied[chat_id] = changed
+    return data, applied
+
+def apply_users_changes(applied: Dict[int, Dict[str, Any]], now: str):
+    """Записали в лист — правим кэш USERS на месте."""
+    for chat_id, changed in applied.items():
+        u = USERS[chat_id]
+        for k, v in changed.items():
+            setattr(u, k, v)
+        u.updated = now
+
+def update_users_batch(changes: Dict[int, Dict[str, Any]]):
+    """Пишет изменившиеся поля существующих пользователей (+ Last_Update) одним values.batchUpdate."""
+    _ensure_users()
+    now = now_utc_str()
+    data, applied = users_batch_data(changes, now)
+    if not data:
+        return
+    sh.values_batch_update(body={"valueInputOption": "RAW", "data": data})
+    apply_users_changes(applied, now)
+
+_UPDATED_ROW = re.compile(r"![A-Z]+(\d+)")  # "Users!A7:N7" -> 7
 
 def upsert_user_row(
     chat_id: int,
@@ -288,32 +512,16 @@ def upsert_user_row(
     w_p_addr: Optional[str] = None,
     w_p_net: Optional[str] = None,
 ):
-    w = ws(USERS_SHEET)
-    headers = w.row_values(1)
-    idx = {h: i for i, h in enumerate(headers)}
-    row_idx = find_user_row_idx(chat_id)
-    def get(row_vals, h, default=""):
-        return row_vals[idx[h]] if (h in idx and idx[h] < len(row_vals)) else default
-    now = now_utc_str()
-    if row_idx:
-        cur = w.row_values(row_idx)
-        values = {h: get(cur, h, "") for h in headers}
-        # apply changes
-        if name is not None: values["Name"] = name
-        if deposit is not None: values["Deposit_USDT"] = str(deposit)
-        if active is not None: values["Active"] = "TRUE" if active else "FALSE"
-        if pending is not None: values["Pending_Deposit"] = str(pending)
-        if bonus_acc is not None: values["Bonus_Accrued"] = str(bonus_acc)
-        if bonus_paid is not None: values["Bonus_Paid"] = str(bonus_paid)
-        if bonus_to_dep is not None: values["Bonus_To_Deposit"] = str(bonus_to_dep)
-        if w_addr is not None: values["Wallet_Address"] = w_addr
-        if w_net is not None: values["Wallet_Network"] = w_net
-        if w_p_addr is not None: values["Wallet_Pending_Address"] = w_p_addr
-        if w_p_net is not None: values["Wallet_Pending_Network"] = w_p_net
-        values["Last_Update"] = now
-        row = [values.get(h, "") for h in headers]
-        w.update(f"A{row_idx}:{chr(64+len(headers))}{row_idx}", [row])
+    fields = {
+        "name": name, "deposit": deposit, "active": active, "pending": pending,
+        "bonus_acc": bonus_acc, "bonus_paid": bonus_paid, "bonus_to_dep": bonus_to_dep,
+        "w_addr": w_addr, "w_net": w_net, "w_p_addr": w_p_addr, "w_p_net": w_p_net,
+    }
+    if find_user_row_idx(chat_id):
+        update_users_batch({chat_id: fields})
     else:
+        headers, _ = sheet_cache.get(USERS_SHEET)
+        now = now_utc_str()
         row = {
             "Chat_ID": str(chat_id),
             "Name": name or "",
@@ -330,30 +538,112 @@ def upsert_user_row(
             "Wallet_Updated_UTC": "",
             "Last_Update": now
         }
-        w.append_row([row.get(h, "") for h in headers], value_input_option="RAW")
+        resp = ws(USERS_SHEET).append_row([row.get(h, "") for h in headers], value_input_option="RAW")
+        m = _UPDATED_ROW.search(((resp or {}).get("updates") or {}).get("updatedRange", ""))
+        if not m:
+            sheet_cache.invalidate(USERS_SHEET)  # номер строки неизвестен — перечитаем лист
+            return
+        # номер новой строки берём из ответа append, без перечитывания листа
+        ROW_INDEX[chat_id] = int(m.group(1))
+        USERS[chat_id] = User(
+            chat_id=chat_id, name=name or "", deposit=float(deposit or 0), active=active is not False,
+            pending=float(pending or 0), bonus_acc=float(bonus_acc or 0), bonus_paid=float(bonus_paid or 0),
+            bonus_to_dep=float(bonus_to_dep or 0), w_addr=w_addr or "", w_net=(w_net or "").upper(),
+            w_p_addr=w_p_addr or "", w_p_net=(w_p_net or "").upper(), updated=now,
+        )
+
+def modify_user(chat_id: int, change: Callable[[Optional[User]], Optional[Dict[str, Any]]]) -> Optional[User]:
+    """Read-modify-write одним вызовом: через sh_run весь он идёт под одним SHEET_LOCK, и опрос не вклинится
+    между чтением пользователя и записью. change(u) -> поля для upsert_user_row (None — ничего не писать).
+    Возвращает пользователя, каким он был при чтении."""
+    u = find_user(chat_id)
+    fields = change(u)
+    if fields:
+        upsert_user_row(chat_id, **fields)
+    return u
+
+def spend_bonus(chat_id: int, req: float, change: Callable[[User, float], Dict[str, Any]]) -> Tuple[Optional[User], float]:
+    """Списание из доступной премии через modify_user: req=NaN — всё доступное, change(u, amount) -> поля.
+    Возвращает (пользователь при чтении, сумма); сумма 0.0 — средств недостаточно, ничего не записано."""
+    amount = 0.0
+    def _change(u: Optional[User]) -> Optional[Dict[str, Any]]:
+        nonlocal amount
+        if not u:
+            return None
+        avail = max(0.0, u.bonus_acc - u.bonus_paid - u.bonus_to_dep)
+        req_amount = avail if (req != req) else req  # NaN => all
+        if req_amount <= 0 or req_amount > avail + 1e-9:
+            return None
+        amount = req_amount
+        return change(u, amount)
+    return modify_user(chat_id, _change), amount
+
+# Записи в Ledger копятся в очереди и пишутся пачкой одним append_rows фоновой задачей
+LEDGER_QUEUE: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+LEDGER_FLUSH_SEC = 2.0
+LEDGER_BATCH = 50
+_ledger_pending: List[Dict[str, Any]] = []  # взяты из очереди, но ещё не записаны
 
 def append_ledger(**kwargs):
+    LEDGER_QUEUE.put_nowait(kwargs)
+
+def write_ledger_rows(entries: List[Dict[str, Any]]):
     w = ws(LEDGER_SHEET)
-    headers = w.row_values(1)
-    row = [str(kwargs.get(h, "")) for h in headers]
+    headers = list(_headers(LEDGER_SHEET))
     # если каких-то полей нет — заполним динамически по совпадению ключей
-    for k, v in kwargs.items():
-        if k not in headers:
-            headers.append(k)
-            # расширим лист + заголовок
-            w.resize(cols=len(headers))
-            w.update(f"A1:{chr(64+len(headers))}1", [headers])
-            row.append(str(v))
-    w.append_row(row, value_input_option="RAW")
+    missing = [k for k in dict.fromkeys(k for e in entries for k in e) if k not in headers]
+    if missing:
+        headers += missing
+        # расширим лист + заголовок
+        w.resize(cols=len(headers))
+        w.update(f"A1:{rowcol_to_a1(1, len(headers))}", [headers])
+        _headers.cache_clear()
+    w.append_rows([[str(e.get(h, "")) for h in headers] for e in entries], value_input_option="RAW")
+
+async def ledger_flusher():
+    while True:
+        if not _ledger_pending:
+            _ledger_pending.append(await LEDGER_QUEUE.get())
+        while len(_ledger_pending) < LEDGER_BATCH and not LEDGER_QUEUE.empty():
+            _ledger_pending.append(LEDGER_QUEUE.get_nowait())
+        batch = _ledger_pending[:]
+        _ledger_pending.clear()  # при отмене задачи запись в потоке всё равно завершится
+        try:
+            await sh_run(write_ledger_rows, batch, locked=False)
+        except Exception:
+            _ledger_pending[:0] = batch
+            log.exception("ledger flush failed (%s rows), retry in %ss", len(batch), LEDGER_FLUSH_SEC)
+        await asyncio.sleep(LEDGER_FLUSH_SEC)
+
+def flush_ledger():
+    """Дописать всё, что осталось в очереди (при остановке бота)."""
+    while not LEDGER_QUEUE.empty():
+        _ledger_pending.append(LEDGER_QUEUE.get_nowait())
+    if _ledger_pending:
+        write_ledger_rows(_ledger_pending)
+        _ledger_pending.clear()
 
 # ------------------- расчёт годовых -------------------
-def annual_forecast(user_bonus_total: float, start_utc: str, user_deposit: float) -> Tuple[float, float]:
+@functools.lru_cache(maxsize=8)
+def _parse_utc(ts: str) -> Optional[datetime]:
+    # Start_UTC не меняется за жизнь бота — strptime один раз на значение
     try:
-        start_dt = datetime.strptime(start_utc, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+        return datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
     except Exception:
-        return 0.0, 0.0
-    days = max((datetime.now(timezone.utc) - start_dt).total_seconds() / 86400.0, 1)
-    if user_deposit <= 0:
+        return None
+
+def days_since(start_utc: str) -> Optional[float]:
+    start_dt = _parse_utc(start_utc)
+    if start_dt is None:
+        return None
+    return max((datetime.now(timezone.utc) - start_dt).total_seconds() / 86400.0, 1)
+
+def annual_forecast(user_bonus_total: float, start_utc: str, user_deposit: float,
+                    days: Optional[float] = None) -> Tuple[float, float]:
+    # days можно посчитать один раз на всю рассылку (days_since) и передать сюда
+    if days is None:
+        days = days_since(start_utc)
+    if days is None or user_deposit <= 0:
         return 0.0, 0.0
     annual_pct = (user_bonus_total / user_deposit) * (365.0 / days) * 100.0
     return annual_pct, user_deposit * annual_pct / 100.0
@@ -388,6 +678,16 @@ ABOUT_TEXT = (
     "Прошлые результаты не гарантируют будущую доходность. Используя бота, вы подтверждаете, что понимаете и принимаете эти риски."
 )
 
+async def notify_admins(app: Application, text: str, what: str = ""):
+    """Рассылка всем админам параллельно (общий лимит 30 msg/s держит AIORateLimiter)."""
+    results = await asyncio.gather(
+        *(app.bot.send_message(chat_id=aid, text=text, parse_mode=constants.ParseMode.HTML) for aid in ADMIN_IDS),
+        return_exceptions=True,
+    )
+    for aid, res in zip(ADMIN_IDS, results):
+        if isinstance(res, Exception):
+            log.warning("notify admin %s failed for %s: %s", what, aid, res)
+
 # ------------------- Telegram handlers: Users -------------------
 async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(START_TEXT, parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
@@ -400,47 +700,34 @@ async def myname(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     name = (update.message.text or "").replace("/myname", "", 1).strip()
     if not name:
         return await update.message.reply_text("Укажите имя: <code>/myname Имя Фамилия</code>", parse_mode=constants.ParseMode.HTML)
-    users = get_users()
-    u = next((x for x in users if x["chat_id"] == chat_id), None)
-    if not u:
-        upsert_user_row(chat_id, name=name, active=False)  # новый пользователь
-        status = "новый"
-    else:
-        upsert_user_row(chat_id, name=name)
-        status = "активный" if u["active"] else "новый"
+    # новый пользователь — не активен
+    u = await sh_run(modify_user, chat_id, lambda u: {"name": name} if u else {"name": name, "active": False})
+    status = "активный" if u and u.active else "новый"
     await update.message.reply_text(f"✅ Имя сохранено: <b>{name}</b>", parse_mode=constants.ParseMode.HTML)
     # уведомим админов
-    for aid in ADMIN_IDS:
-        try:
-            await ctx.application.bot.send_message(
-                chat_id=aid,
-                text=f"👤 NEW/UPDATE NAME\nПользователь: <b>{name}</b> (id <code>{chat_id}</code>, {status})",
-                parse_mode=constants.ParseMode.HTML
-            )
-        except Exception as e:
-            log.warning(f"notify admin name failed: {e}")
+    text = f"👤 NEW/UPDATE NAME\nПользователь: <b>{name}</b> (id <code>{chat_id}</code>, {status})"
+    await notify_admins(ctx.application, text, "name")
 
 async def balance(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    users = get_users()
-    u = next((x for x in users if x["chat_id"] == chat_id), None)
-    if not u or not u["active"]:
+    u = await sh_run(find_user, chat_id)
+    if not u or not u.active:
         return await update.message.reply_text("Вы ещё не подключены. Отправьте /start и передайте ваш chat_id админу.")
     # доступная премия = начислено - выплачено - переведено в депозит
-    bonus_avail = max(0.0, u["bonus_acc"] - u["bonus_paid"] - u["bonus_to_dep"])
+    bonus_avail = max(0.0, u.bonus_acc - u.bonus_paid - u.bonus_to_dep)
     # кошелёк
     wallet_line = "—"
-    if u["w_addr"]:
-        wallet_line = f"{u['w_addr']} / {u['w_net'] or 'TRC20'}"
-    elif u["w_p_addr"]:
-        wallet_line = f"(в ожидании) {u['w_p_addr']} / {u['w_p_net'] or 'TRC20'}"
+    if u.w_addr:
+        wallet_line = f"{u.w_addr} / {u.w_net or 'TRC20'}"
+    elif u.w_p_addr:
+        wallet_line = f"(в ожидании) {u.w_p_addr} / {u.w_p_net or 'TRC20'}"
     # итог
     txt = (
         f"🧰 <b>Баланс</b>\n\n"
-        f"Депозит: <b>${fmt_usd(u['deposit'])}</b>\n"
-        f"Премия (начислено): <b>${fmt_usd(u['bonus_acc'])}</b>\n"
-        f"— выплачено: <b>${fmt_usd(u['bonus_paid'])}</b>\n"
-        f"— переведено в депозит: <b>${fmt_usd(u['bonus_to_dep'])}</b>\n"
+        f"Депозит: <b>${fmt_usd(u.deposit)}</b>\n"
+        f"Премия (начислено): <b>${fmt_usd(u.bonus_acc)}</b>\n"
+        f"— выплачено: <b>${fmt_usd(u.bonus_paid)}</b>\n"
+        f"— переведено в депозит: <b>${fmt_usd(u.bonus_to_dep)}</b>\n"
         f"Доступно к выводу: <b>${fmt_usd(bonus_avail)}</b>\n\n"
         f"Кошелёк для выводов: <b>{wallet_line}</b>"
     )
@@ -457,20 +744,18 @@ async def add_deposit(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             raise ValueError
     except Exception:
         return await update.message.reply_text("Сумма некорректна. Пример: <code>/add_deposit 500</code>", parse_mode=constants.ParseMode.HTML)
-    users = get_users()
-    u = next((x for x in users if x["chat_id"] == chat_id), None)
+    # Pending трактуем как целевой депозит (текущий + добавка); нет карточки — создадим (не активен)
+    u = await sh_run(modify_user, chat_id, lambda u: (
+        {"pending": u.deposit + add} if u else {"name": str(chat_id), "active": False, "pending": add}
+    ))
     if not u:
-        # создадим карточку пользователя (не активен)
-        upsert_user_row(chat_id, name=str(chat_id), active=False, pending=add)
         current_dep = 0.0
         status = "новый"
         name = str(chat_id)
     else:
-        current_dep = u["deposit"]
-        name = u["name"] or str(chat_id)
-        # Pending трактуем как целевой депозит (текущий + добавка)
-        upsert_user_row(chat_id, pending=current_dep + add)
-        status = "активный" if u["active"] else "новый"
+        current_dep = u.deposit
+        name = u.name or str(chat_id)
+        status = "активный" if u.active else "новый"
     append_ledger(
         **{
             "Timestamp_UTC": now_utc_str(), "Type": "DEPOSIT_ADD_REQUEST", "Chat_ID": chat_id,
@@ -479,139 +764,105 @@ async def add_deposit(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text("📨 Заявка на пополнение депозита отправлена админу. Депозит активируется со следующей сделкой.")
     # уведомление админам + подсказка команды
-    for aid in ADMIN_IDS:
-        try:
-            cmd = f"/setdep {chat_id} {current_dep + add:.2f}"
-            await ctx.application.bot.send_message(
-                chat_id=aid,
-                text=(f"💵 DEPOSIT_ADD_REQUEST\n"
-                      f"Пользователь: <b>{name}</b> (id <code>{chat_id}</code>, {status})\n"
-                      f"Текущий депозит: ${fmt_usd(current_dep)}\n"
-                      f"Запрошено добавить: ${fmt_usd(add)}\n"
-                      f"👉 Применить со след. сделки: <code>{cmd}</code>"),
-                parse_mode=constants.ParseMode.HTML
-            )
-        except Exception as e:
-            log.warning(f"notify admin add_deposit failed: {e}")
+    cmd = f"/setdep {chat_id} {current_dep + add:.2f}"
+    text = (f"💵 DEPOSIT_ADD_REQUEST\n"
+            f"Пользователь: <b>{name}</b> (id <code>{chat_id}</code>, {status})\n"
+            f"Текущий депозит: ${fmt_usd(current_dep)}\n"
+            f"Запрошено добавить: ${fmt_usd(add)}\n"
+            f"👉 Применить со след. сделки: <code>{cmd}</code>")
+    await notify_admins(ctx.application, text, "add_deposit")
 
 async def add_from_bonus(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     args = (ctx.args or [])
     if not args:
         return await update.message.reply_text("Использование: <code>/add_from_bonus 100</code>", parse_mode=constants.ParseMode.HTML)
-    users = get_users()
-    u = next((x for x in users if x["chat_id"] == chat_id), None)
-    if not u:
-        return await update.message.reply_text("Сначала укажите имя /myname и добавьте депозит /add_deposit.")
     try:
         req = parse_money(args[0])
-        bonus_avail = max(0.0, u["bonus_acc"] - u["bonus_paid"] - u["bonus_to_dep"])
-        amount = bonus_avail if (req != req) else req  # NaN => all
-        if amount <= 0 or amount > bonus_avail + 1e-9:
-            raise ValueError
     except Exception:
-        return await update.message.reply_text(f"Недостаточно средств. Доступно из премии: ${fmt_usd(max(0.0, u['bonus_acc']-u['bonus_paid']-u['bonus_to_dep']))}")
-    target_dep = u["deposit"] + amount
-    upsert_user_row(chat_id, pending=target_dep)
+        req = 0.0  # некорректная сумма — ответим «недостаточно средств»
+    u, amount = await sh_run(spend_bonus, chat_id, req, lambda u, a: {"pending": u.deposit + a})
+    if not u:
+        return await update.message.reply_text("Сначала укажите имя /myname и добавьте депозит /add_deposit.")
+    if not amount:
+        return await update.message.reply_text(f"Недостаточно средств. Доступно из премии: ${fmt_usd(max(0.0, u.bonus_acc-u.bonus_paid-u.bonus_to_dep))}")
+    target_dep = u.deposit + amount
     append_ledger(
         **{
             "Timestamp_UTC": now_utc_str(), "Type": "BONUS_TO_DEPOSIT_REQUEST", "Chat_ID": chat_id,
-            "Name": u["name"] or str(chat_id), "Amount_USDT": amount, "Note": "Премия в депозит", "Status": "PENDING"
+            "Name": u.name or str(chat_id), "Amount_USDT": amount, "Note": "Премия в депозит", "Status": "PENDING"
         }
     )
     await update.message.reply_text("📨 Заявка на пополнение из премии отправлена админу. Изменение вступит со следующей сделкой.")
-    for aid in ADMIN_IDS:
-        try:
-            cmd = f"/apply_from_bonus {chat_id} {amount:.2f}"
-            cmd2 = f"/setdep {chat_id} {target_dep:.2f}"
-            await ctx.application.bot.send_message(
-                chat_id=aid,
-                text=(f"💼 BONUS_TO_DEPOSIT_REQUEST\n"
-                      f"Пользователь: <b>{u['name'] or chat_id}</b> (id <code>{chat_id}</code>, {'активный' if u['active'] else 'новый'})\n"
-                      f"Доступно из премии: ${fmt_usd(max(0.0,u['bonus_acc']-u['bonus_paid']-u['bonus_to_dep']))}\n"
-                      f"Запрошено перевести: ${fmt_usd(amount)}\n"
-                      f"👉 Списать из премии: <code>{cmd}</code>\n"
-                      f"👉 Обновить депозит со след. сделки: <code>{cmd2}</code>"),
-                parse_mode=constants.ParseMode.HTML
-            )
-        except Exception as e:
-            log.warning(f"notify admin add_from_bonus failed: {e}")
+    cmd = f"/apply_from_bonus {chat_id} {amount:.2f}"
+    cmd2 = f"/setdep {chat_id} {target_dep:.2f}"
+    text = (f"💼 BONUS_TO_DEPOSIT_REQUEST\n"
+            f"Пользователь: <b>{u.name or chat_id}</b> (id <code>{chat_id}</code>, {'активный' if u.active else 'новый'})\n"
+            f"Доступно из премии: ${fmt_usd(max(0.0,u.bonus_acc-u.bonus_paid-u.bonus_to_dep))}\n"
+            f"Запрошено перевести: ${fmt_usd(amount)}\n"
+            f"👉 Списать из премии: <code>{cmd}</code>\n"
+            f"👉 Обновить депозит со след. сделки: <code>{cmd2}</code>")
+    await notify_admins(ctx.application, text, "add_from_bonus")
 
 async def withdraw_bonus(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     args = (ctx.args or [])
     if not args:
         return await update.message.reply_text("Использование: <code>/withdraw_bonus 100</code> или <code>/withdraw_bonus all</code>", parse_mode=constants.ParseMode.HTML)
-    users = get_users()
-    u = next((x for x in users if x["chat_id"] == chat_id), None)
+    u = await sh_run(find_user, chat_id)
     if not u:
         return await update.message.reply_text("Сначала укажите имя /myname и добавьте депозит /add_deposit.")
     # проверим кошелёк
-    if not u["w_addr"]:
+    if not u.w_addr:
         return await update.message.reply_text("⚠️ Кошелёк для выводов не указан. Установите: <code>/setwallet &lt;адрес&gt; TRC20</code>", parse_mode=constants.ParseMode.HTML)
     try:
         req = parse_money(args[0])
-        bonus_avail = max(0.0, u["bonus_acc"] - u["bonus_paid"] - u["bonus_to_dep"])
+        bonus_avail = max(0.0, u.bonus_acc - u.bonus_paid - u.bonus_to_dep)
         amount = bonus_avail if (req != req) else req  # NaN => all
         if amount <= 0 or amount > bonus_avail + 1e-9:
             raise ValueError
     except Exception:
-        return await update.message.reply_text(f"Недостаточно средств. Доступно к выводу: ${fmt_usd(max(0.0,u['bonus_acc']-u['bonus_paid']-u['bonus_to_dep']))}")
+        return await update.message.reply_text(f"Недостаточно средств. Доступно к выводу: ${fmt_usd(max(0.0,u.bonus_acc-u.bonus_paid-u.bonus_to_dep))}")
     append_ledger(
         **{
             "Timestamp_UTC": now_utc_str(), "Type": "WITHDRAW_BONUS_REQUEST", "Chat_ID": chat_id,
-            "Name": u["name"] or str(chat_id), "Amount_USDT": amount,
-            "Note": f"Вывод премии на {u['w_addr']} / {u['w_net'] or 'TRC20'}", "Status": "PENDING"
+            "Name": u.name or str(chat_id), "Amount_USDT": amount,
+            "Note": f"Вывод премии на {u.w_addr} / {u.w_net or 'TRC20'}", "Status": "PENDING"
         }
     )
     await update.message.reply_text("📨 Заявка на вывод премии отправлена админу. Ожидайте подтверждения.")
-    for aid in ADMIN_IDS:
-        try:
-            cmd = f"/pay_bonus {chat_id} {amount:.2f}"
-            await ctx.application.bot.send_message(
-                chat_id=aid,
-                text=(f"💸 WITHDRAW_BONUS_REQUEST\n"
-                      f"Пользователь: <b>{u['name'] or chat_id}</b> (id <code>{chat_id}</code>, {'активный' if u['active'] else 'новый'})\n"
-                      f"Сумма: ${fmt_usd(amount)}\n"
-                      f"Кошелёк: {u['w_addr']} / {u['w_net'] or 'TRC20'}\n"
-                      f"👉 Выплатить: <code>{cmd}</code>"),
-                parse_mode=constants.ParseMode.HTML
-            )
-        except Exception as e:
-            log.warning(f"notify admin withdraw_bonus failed: {e}")
+    cmd = f"/pay_bonus {chat_id} {amount:.2f}"
+    text = (f"💸 WITHDRAW_BONUS_REQUEST\n"
+            f"Пользователь: <b>{u.name or chat_id}</b> (id <code>{chat_id}</code>, {'активный' if u.active else 'новый'})\n"
+            f"Сумма: ${fmt_usd(amount)}\n"
+            f"Кошелёк: {u.w_addr} / {u.w_net or 'TRC20'}\n"
+            f"👉 Выплатить: <code>{cmd}</code>")
+    await notify_admins(ctx.application, text, "withdraw_bonus")
 
 async def withdraw_all(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    users = get_users()
-    u = next((x for x in users if x["chat_id"] == chat_id), None)
+    u = await sh_run(find_user, chat_id)
     if not u:
         return await update.message.reply_text("Вы ещё не подключены. Отправьте /start и передайте ваш chat_id админу.")
-    if not u["w_addr"]:
+    if not u.w_addr:
         return await update.message.reply_text("⚠️ Кошелёк для выводов не указан. Установите: <code>/setwallet &lt;адрес&gt; TRC20</code>", parse_mode=constants.ParseMode.HTML)
-    bonus_avail = max(0.0, u["bonus_acc"] - u["bonus_paid"] - u["bonus_to_dep"])
-    total = u["deposit"] + bonus_avail
+    bonus_avail = max(0.0, u.bonus_acc - u.bonus_paid - u.bonus_to_dep)
+    total = u.deposit + bonus_avail
     append_ledger(
         **{
             "Timestamp_UTC": now_utc_str(), "Type": "WITHDRAW_ALL_REQUEST", "Chat_ID": chat_id,
-            "Name": u["name"] or str(chat_id), "Amount_USDT": total,
-            "Note": f"Вывод депозита+премии на {u['w_addr']} / {u['w_net'] or 'TRC20'}", "Status": "PENDING"
+            "Name": u.name or str(chat_id), "Amount_USDT": total,
+            "Note": f"Вывод депозита+премии на {u.w_addr} / {u.w_net or 'TRC20'}", "Status": "PENDING"
         }
     )
     await update.message.reply_text("📨 Заявка на вывод депозита и премии отправлена админу. После обработки вы будете отключены.")
-    for aid in ADMIN_IDS:
-        try:
-            cmd = f"/pay_all {chat_id}"
-            await ctx.application.bot.send_message(
-                chat_id=aid,
-                text=(f"🏁 WITHDRAW_ALL_REQUEST\n"
-                      f"Пользователь: <b>{u['name'] or chat_id}</b> (id <code>{chat_id}</code>, {'активный' if u['active'] else 'новый'})\n"
-                      f"К выплате: депозит ${fmt_usd(u['deposit'])} + премия ${fmt_usd(bonus_avail)} = <b>${fmt_usd(total)}</b>\n"
-                      f"Кошелёк: {u['w_addr']} / {u['w_net'] or 'TRC20'}\n"
-                      f"👉 Выплатить и отключить: <code>{cmd}</code>"),
-                parse_mode=constants.ParseMode.HTML
-            )
-        except Exception as e:
-            log.warning(f"notify admin withdraw_all failed: {e}")
+    cmd = f"/pay_all {chat_id}"
+    text = (f"🏁 WITHDRAW_ALL_REQUEST\n"
+            f"Пользователь: <b>{u.name or chat_id}</b> (id <code>{chat_id}</code>, {'активный' if u.active else 'новый'})\n"
+            f"К выплате: депозит ${fmt_usd(u.deposit)} + премия ${fmt_usd(bonus_avail)} = <b>${fmt_usd(total)}</b>\n"
+            f"Кошелёк: {u.w_addr} / {u.w_net or 'TRC20'}\n"
+            f"👉 Выплатить и отключить: <code>{cmd}</code>")
+    await notify_admins(ctx.application, text, "withdraw_all")
 
 # ------------------- кошельки (user) -------------------
 def guess_net(addr: str) -> str:
@@ -623,15 +874,15 @@ def guess_net(addr: str) -> str:
 
 async def mywallet(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    u = next((x for x in get_users() if x["chat_id"] == chat_id), None)
+    u = await sh_run(find_user, chat_id)
     if not u:
         return await update.message.reply_text("Кошелёк не задан. Установите: <code>/setwallet &lt;адрес&gt; [сеть]</code>", parse_mode=constants.ParseMode.HTML)
-    if u["w_addr"]:
+    if u.w_addr:
         txt = (f"💼 Текущий кошелёк для выводов:\n"
-               f"<code>{u['w_addr']}</code> / <b>{u['w_net'] or 'TRC20'}</b>\n"
+               f"<code>{u.w_addr}</code> / <b>{u.w_net or 'TRC20'}</b>\n"
                f"Сменить: <code>/setwallet &lt;адрес&gt; [сеть]</code> или очистить <code>/clearwallet</code>.")
     else:
-        pend = f"(ожидание) {u['w_p_addr']} / {u['w_p_net']}" if u["w_p_addr"] else "—"
+        pend = f"(ожидание) {u.w_p_addr} / {u.w_p_net}" if u.w_p_addr else "—"
         txt = (f"⚠️ Кошелёк не указан.\n"
                f"Установите: <code>/setwallet &lt;адрес&gt; [сеть]</code> (по умолчанию TRC20)\n"
                f"Текущая заявка: {pend}")
@@ -644,40 +895,31 @@ async def setwallet(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("Использование: <code>/setwallet TVS… TRC20</code>", parse_mode=constants.ParseMode.HTML)
     addr = args[0].strip()
     net  = (args[1].strip().upper() if len(args) >= 2 else guess_net(addr))
-    u = next((x for x in get_users() if x["chat_id"] == chat_id), None)
+    wallet = {"w_p_addr": addr, "w_p_net": net}
+    u = await sh_run(modify_user, chat_id, lambda u: wallet if u else {"name": str(chat_id), "active": False, **wallet})
     if not u:
-        upsert_user_row(chat_id, name=str(chat_id), active=False, w_p_addr=addr, w_p_net=net)
         name = str(chat_id); status = "новый"
     else:
-        upsert_user_row(chat_id, w_p_addr=addr, w_p_net=net)
-        name = u["name"] or str(chat_id); status = "активный" if u["active"] else "новый"
+        name = u.name or str(chat_id); status = "активный" if u.active else "новый"
     append_ledger(**{
         "Timestamp_UTC": now_utc_str(), "Type": "WALLET_SET_REQUEST",
-        "Chat_ID": chat_id, "Name": name, "Old_Address": u["w_addr"] if u else "",
-        "Old_Network": u["w_net"] if u else "", "New_Address": addr, "New_Network": net, "Status": "PENDING"
+        "Chat_ID": chat_id, "Name": name, "Old_Address": u.w_addr if u else "",
+        "Old_Network": u.w_net if u else "", "New_Address": addr, "New_Network": net, "Status": "PENDING"
     })
     await update.message.reply_text("📨 Заявка на установку кошелька отправлена админу.")
-    for aid in ADMIN_IDS:
-        try:
-            await ctx.application.bot.send_message(
-                chat_id=aid,
-                text=(f"📨 WALLET_SET_REQUEST\n"
-                      f"Пользователь: <b>{name}</b> (id <code>{chat_id}</code>, {status})\n"
-                      f"Старый: {u['w_addr'] if u else ''} / {u['w_net'] if u else ''}\n"
-                      f"Новый: {addr} / {net}\n"
-                      f"👉 Подтвердить: <code>/approve_wallet {chat_id}</code>\n"
-                      f"👉 Отклонить: <code>/reject_wallet {chat_id} причина</code>"),
-                parse_mode=constants.ParseMode.HTML
-            )
-        except Exception as e:
-            log.warning(f"notify admin wallet failed: {e}")
+    text = (f"📨 WALLET_SET_REQUEST\n"
+            f"Пользователь: <b>{name}</b> (id <code>{chat_id}</code>, {status})\n"
+            f"Старый: {u.w_addr if u else ''} / {u.w_net if u else ''}\n"
+            f"Новый: {addr} / {net}\n"
+            f"👉 Подтвердить: <code>/approve_wallet {chat_id}</code>\n"
+            f"👉 Отклонить: <code>/reject_wallet {chat_id} причина</code>")
+    await notify_admins(ctx.application, text, "wallet")
 
 async def clearwallet(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    u = next((x for x in get_users() if x["chat_id"] == chat_id), None)
+    u = await sh_run(modify_user, chat_id, lambda u: {"w_p_addr": "", "w_p_net": ""} if u else None)
     if not u:
         return await update.message.reply_text("Вы ещё не подключены. Отправьте /start.")
-    upsert_user_row(chat_id, w_p_addr="", w_p_net="")
     await update.message.reply_text("Заявка на очистку кошелька отправлена админу. (Отклоните/подтвердите через /reject_wallet или /approve_wallet)")
 
 # ------------------- Telegram handlers: Admin -------------------
@@ -707,7 +949,7 @@ async def adduser(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         name = " ".join(args[1:-1]).strip() or str(chat_id)
     except (ValueError, IndexError):
         return await update.message.reply_text("Использование: /adduser <chat_id> <Имя> <депозит>")
-    upsert_user_row(chat_id, name=name, deposit=dep, active=True)
+    await sh_run(upsert_user_row, chat_id, name=name, deposit=dep, active=True)
     await update.message.reply_text(f"OK. Пользователь {name} ({chat_id}) добавлен с депозитом ${fmt_usd(dep)}.")
     try:
         await set_menu_user(ctx.application, chat_id)
@@ -717,10 +959,10 @@ async def adduser(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             parse_mode=constants.ParseMode.HTML
         )
     except Exception as e:
-        log.warning(f"greet adduser failed: {e}")
+        log.warning("greet adduser failed: %s", e)
 
 def _parse_setdep_text(text: str):
-    m = re.match(r"^/setdep\s+(-?\d+)\s+([0-9][\d\s.,]*)\s*$", (text or "").strip(), re.I)
+    m = _SETDEP_RE.match((text or "").strip())
     if not m: return None
     return int(m.group(1)), parse_money(m.group(2))
 
@@ -730,7 +972,7 @@ async def setdep(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not parsed:
         return await update.message.reply_text("Использование: /setdep <chat_id> <депозит>")
     chat_id, dep = parsed
-    upsert_user_row(chat_id, pending=dep)
+    await sh_run(upsert_user_row, chat_id, pending=dep)
     await update.message.reply_text(f"OK. Pending-депозит ${fmt_usd(dep)} применится со следующей сделкой.")
     try:
         await ctx.application.bot.send_message(
@@ -747,7 +989,7 @@ async def setname_admin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         if not name: raise ValueError
     except (IndexError, ValueError):
         return await update.message.reply_text("Использование: /setname <chat_id> <Новое Имя>")
-    upsert_user_row(chat_id, name=name)
+    await sh_run(upsert_user_row, chat_id, name=name)
     await update.message.reply_text("OK. Имя обновлено.")
 
 async def remove(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -756,7 +998,7 @@ async def remove(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         chat_id = int(ctx.args[0])
     except (IndexError, ValueError):
         return await update.message.reply_text("Использование: /remove <chat_id>")
-    upsert_user_row(chat_id, active=False)
+    await sh_run(upsert_user_row, chat_id, active=False)
     await update.message.reply_text("OK. Пользователь деактивирован.")
     try:
         await ctx.application.bot.set_my_commands([BotCommand("start", "Как подключиться"), BotCommand("about","О боте")], scope=BotCommandScopeChat(chat_id))
@@ -765,13 +1007,13 @@ async def remove(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def list_users(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update): return
-    users = get_users()
+    users = await sh_run(get_users)
     if not users:
         return await update.message.reply_text("Список пуст.")
     lines = []
     for u in users:
-        status = "✅ активный" if u["active"] else "🆕 новый/неактивный"
-        lines.append(f"{status} — {u['name'] or u['chat_id']} | dep={fmt_usd(u['deposit'])} | pend={fmt_usd(u['pending'])} | id={u['chat_id']}")
+        status = "✅ активный" if u.active else "🆕 новый/неактивный"
+        lines.append(f"{status} — {u.name or u.chat_id} | dep={fmt_usd(u.deposit)} | pend={fmt_usd(u.pending)} | id={u.chat_id}")
     await update.message.reply_text("\n".join(lines))
 
 async def approve_wallet(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -780,20 +1022,20 @@ async def approve_wallet(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         chat_id = int(ctx.args[0])
     except Exception:
         return await update.message.reply_text("Использование: /approve_wallet <chat_id>")
-    users = get_users()
-    u = next((x for x in users if x["chat_id"] == chat_id), None)
-    if not u or not u["w_p_addr"]:
-        return await update.message.reply_text("Нет ожидающей заявки на кошелёк.")
     # переносим pending -> активный
-    upsert_user_row(chat_id, w_addr=u["w_p_addr"], w_net=u["w_p_net"], w_p_addr="", w_p_net="")
+    u = await sh_run(modify_user, chat_id, lambda u: (
+        {"w_addr": u.w_p_addr, "w_net": u.w_p_net, "w_p_addr": "", "w_p_net": ""} if u and u.w_p_addr else None
+    ))
+    if not u or not u.w_p_addr:
+        return await update.message.reply_text("Нет ожидающей заявки на кошелёк.")
     append_ledger(**{
         "Timestamp_UTC": now_utc_str(), "Type": "WALLET_SET_APPROVED",
-        "Chat_ID": chat_id, "Name": u["name"] or chat_id, "Old_Address": u["w_addr"], "Old_Network": u["w_net"],
-        "New_Address": u["w_p_addr"], "New_Network": u["w_p_net"], "Admin": update.effective_user.id, "Status": "OK"
+        "Chat_ID": chat_id, "Name": u.name or chat_id, "Old_Address": u.w_addr, "Old_Network": u.w_net,
+        "New_Address": u.w_p_addr, "New_Network": u.w_p_net, "Admin": update.effective_user.id, "Status": "OK"
     })
     await update.message.reply_text("OK. Кошелёк утверждён.")
     try:
-        await ctx.application.bot.send_message(chat_id=chat_id, text=f"✅ Кошелёк утверждён: <code>{u['w_p_addr']}</code> / <b>{u['w_p_net']}</b>", parse_mode=constants.ParseMode.HTML)
+        await ctx.application.bot.send_message(chat_id=chat_id, text=f"✅ Кошелёк утверждён: <code>{u.w_p_addr}</code> / <b>{u.w_p_net}</b>", parse_mode=constants.ParseMode.HTML)
     except Exception: pass
 
 async def reject_wallet(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -802,13 +1044,11 @@ async def reject_wallet(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         chat_id = int(ctx.args[0]); reason = " ".join(ctx.args[1:]).strip() or "—"
     except Exception:
         return await update.message.reply_text("Использование: /reject_wallet <chat_id> [причина]")
-    users = get_users()
-    u = next((x for x in users if x["chat_id"] == chat_id), None)
-    upsert_user_row(chat_id, w_p_addr="", w_p_net="")
+    u = await sh_run(modify_user, chat_id, lambda u: {"w_p_addr": "", "w_p_net": ""})
     append_ledger(**{
         "Timestamp_UTC": now_utc_str(), "Type": "WALLET_SET_REJECTED",
-        "Chat_ID": chat_id, "Name": (u and (u["name"] or chat_id)) or chat_id,
-        "New_Address": (u and u["w_p_addr"]) or "", "New_Network": (u and u["w_p_net"]) or "",
+        "Chat_ID": chat_id, "Name": (u and (u.name or chat_id)) or chat_id,
+        "New_Address": (u and u.w_p_addr) or "", "New_Network": (u and u.w_p_net) or "",
         "Admin": update.effective_user.id, "Status": "REJECT", "Note": reason
     })
     await update.message.reply_text("OK. Заявка отклонена.")
@@ -822,19 +1062,16 @@ async def apply_from_bonus(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         chat_id = int(ctx.args[0]); req = parse_money(ctx.args[1])
     except Exception:
         return await update.message.reply_text("Использование: /apply_from_bonus <chat_id> <сумма|all>")
-    u = next((x for x in get_users() if x["chat_id"] == chat_id), None)
+    # учтём перевод в депозит (со след. сделки)
+    u, amount = await sh_run(spend_bonus, chat_id, req, lambda u, a: {"pending": u.deposit + a, "bonus_to_dep": u.bonus_to_dep + a})
     if not u:
         return await update.message.reply_text("Пользователь не найден.")
-    avail = max(0.0, u["bonus_acc"] - u["bonus_paid"] - u["bonus_to_dep"])
-    amount = avail if (req != req) else req
-    if amount <= 0 or amount > avail + 1e-9:
-        return await update.message.reply_text(f"Недостаточно средств. Доступно: ${fmt_usd(avail)}")
-    # учтём перевод в депозит (со след. сделки)
-    target_dep = u["deposit"] + amount
-    upsert_user_row(chat_id, pending=target_dep, bonus_to_dep=u["bonus_to_dep"] + amount)
+    if not amount:
+        return await update.message.reply_text(f"Недостаточно средств. Доступно: ${fmt_usd(max(0.0, u.bonus_acc - u.bonus_paid - u.bonus_to_dep))}")
+    target_dep = u.deposit + amount
     append_ledger(**{
         "Timestamp_UTC": now_utc_str(), "Type": "BONUS_TO_DEPOSIT_APPLIED", "Chat_ID": chat_id,
-        "Name": u["name"] or chat_id, "Amount_USDT": amount, "Admin": update.effective_user.id, "Status": "OK"
+        "Name": u.name or chat_id, "Amount_USDT": amount, "Admin": update.effective_user.id, "Status": "OK"
     })
     await update.message.reply_text(f"OK. Из премии переведено ${fmt_usd(amount)}. Pending депозит: ${fmt_usd(target_dep)}")
 
@@ -844,21 +1081,18 @@ async def pay_bonus(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         chat_id = int(ctx.args[0]); req = parse_money(ctx.args[1])
     except Exception:
         return await update.message.reply_text("Использование: /pay_bonus <chat_id> <сумма|all>")
-    u = next((x for x in get_users() if x["chat_id"] == chat_id), None)
+    u, amount = await sh_run(spend_bonus, chat_id, req, lambda u, a: {"bonus_paid": u.bonus_paid + a})
     if not u:
         return await update.message.reply_text("Пользователь не найден.")
-    avail = max(0.0, u["bonus_acc"] - u["bonus_paid"] - u["bonus_to_dep"])
-    amount = avail if (req != req) else req
-    if amount <= 0 or amount > avail + 1e-9:
-        return await update.message.reply_text(f"Недостаточно средств. Доступно: ${fmt_usd(avail)}")
-    upsert_user_row(chat_id, bonus_paid=u["bonus_paid"] + amount)
+    if not amount:
+        return await update.message.reply_text(f"Недостаточно средств. Доступно: ${fmt_usd(max(0.0, u.bonus_acc - u.bonus_paid - u.bonus_to_dep))}")
     append_ledger(**{
         "Timestamp_UTC": now_utc_str(), "Type": "BONUS_PAID",
-        "Chat_ID": chat_id, "Name": u["name"] or chat_id, "Amount_USDT": amount,
+        "Chat_ID": chat_id, "Name": u.name or chat_id, "Amount_USDT": amount,
         "Admin": update.effective_user.id, "Tx_Direction": "OUT", "Status": "OK",
-        "Note": f"to {u['w_addr']} / {u['w_net'] or 'TRC20'}"
+        "Note": f"to {u.w_addr} / {u.w_net or 'TRC20'}"
     })
-    await update.message.reply_text(f"OK. Выплачено ${fmt_usd(amount)} премии пользователю {u['name'] or chat_id}.")
+    await update.message.reply_text(f"OK. Выплачено ${fmt_usd(amount)} премии пользователю {u.name or chat_id}.")
     try:
         await ctx.application.bot.send_message(chat_id=chat_id, text=f"💸 Перевод отправлен: ${fmt_usd(amount)} (премия).")
     except Exception: pass
@@ -869,18 +1103,20 @@ async def pay_all(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         chat_id = int(ctx.args[0])
     except Exception:
         return await update.message.reply_text("Использование: /pay_all <chat_id>")
-    u = next((x for x in get_users() if x["chat_id"] == chat_id), None)
+    # списываем всё: депозит -> 0, бонус_paid += bonus_avail, active=False
+    u = await sh_run(modify_user, chat_id, lambda u: (
+        {"deposit": 0.0, "active": False, "bonus_paid": u.bonus_paid + max(0.0, u.bonus_acc - u.bonus_paid - u.bonus_to_dep)}
+        if u else None
+    ))
     if not u:
         return await update.message.reply_text("Пользователь не найден.")
-    bonus_avail = max(0.0, u["bonus_acc"] - u["bonus_paid"] - u["bonus_to_dep"])
-    amount = u["deposit"] + bonus_avail
-    # списываем всё: депозит -> 0, бонус_paid += bonus_avail, active=False
-    upsert_user_row(chat_id, deposit=0.0, active=False, bonus_paid=u["bonus_paid"] + bonus_avail)
+    bonus_avail = max(0.0, u.bonus_acc - u.bonus_paid - u.bonus_to_dep)
+    amount = u.deposit + bonus_avail
     append_ledger(**{
         "Timestamp_UTC": now_utc_str(), "Type": "ALL_WITHDRAWN",
-        "Chat_ID": chat_id, "Name": u["name"] or chat_id, "Amount_USDT": amount,
+        "Chat_ID": chat_id, "Name": u.name or chat_id, "Amount_USDT": amount,
         "Admin": update.effective_user.id, "Tx_Direction": "OUT", "Status": "OK",
-        "Note": f"deposit+bonus to {u['w_addr']} / {u['w_net'] or 'TRC20'}"
+        "Note": f"deposit+bonus to {u.w_addr} / {u.w_net or 'TRC20'}"
     })
     await update.message.reply_text(f"OK. Выплачено ${fmt_usd(amount)} и пользователь отключён.")
     try:
@@ -890,129 +1126,307 @@ async def pay_all(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     except Exception: pass
 
 # ------------------- Trading log polling (30% модель) -------------------
-open_positions: Dict[str, Dict[str, Any]] = {}  # sid -> {cum_margin, snapshot: [(chat_id, deposit)], users:[ids]}
+@dataclass(slots=True)
+class OpenPosition:
+    cum_margin: float
+    snapshot: List[Tuple[int, float]]  # (chat_id, deposit) на момент OPEN
+    ts: float                          # time.time() открытия — для OPEN_POS_TTL
+
+    @property
+    def users(self) -> List[int]:
+        return [cid for cid, _ in self.snapshot]
+
+open_positions: Dict[str, OpenPosition] = {}  # sid -> позиция, в порядке открытия
+OPEN_POS_TTL = 14 * 86400   # позиция без CLOSE дольше — считаем потерянной
+OPEN_POS_MAX = 500          # сверх лимита вытесняем самые старые
+STATE_CELL_MAX = 50000      # лимит символов в ячейке Sheets
+
+def dump_open_positions(positions: Dict[str, OpenPosition]) -> str:
+    """Компактный JSON для State!D2: sid -> [ts, cum_margin, [[chat_id, deposit], ...]] (users = chat_id из snapshot)."""
+    raw = json.dumps(
+        {sid: [int(p.ts), p.cum_margin, p.snapshot] for sid, p in positions.items()},
+        separators=(",", ":"),
+    )
+    if len(raw) > STATE_CELL_MAX:
+        log.warning("open_positions too large to persist (%s chars), keeping in memory only", len(raw))
+        return ""  # очищаем ячейку, чтобы после рестарта не поднять устаревший снимок
+    return raw
 
-async def send_all(app: Application, text_by_user: Dict[int, str]):
-    for chat_id, text in text_by_user.items():
-        if text.strip():
+def load_open_positions():
+    try:
+        raw = get_open_positions_json()
+        for sid, (ts, cm, snapshot) in (json.loads(raw) if raw else {}).items():
+            snapshot = [(int(cid), float(dep)) for cid, dep in snapshot]
+            open_positions[sid] = OpenPosition(float(cm), snapshot, float(ts))
+    except Exception as e:
+        log.warning("open_positions restore failed: %s", e)
+
+def sweep_open_positions(positions: Dict[str, OpenPosition]):
+    now = time.time()
+    for sid in [sid for sid, p in positions.items() if now - p.ts > OPEN_POS_TTL]:
+        log.warning("drop stale open position %s", sid)
+        positions.pop(sid, None)
+    while len(positions) > OPEN_POS_MAX:
+        sid = next(iter(positions))  # dict хранит порядок вставки — первой идёт самая старая
+        log.warning("drop oldest open position %s (limit %s)", sid, OPEN_POS_MAX)
+        del positions[sid]
+
+SEND_CONCURRENCY = 25  # < 30 msg/s — общий лимит Telegram на бота
+SEND_RETRIES = 2       # повторы после RetryAfter (429)
+_send_sem = asyncio.Semaphore(SEND_CONCURRENCY)
+
+async def _deliver(chat_id: int, send):
+    """send() -> корутина отправки; повтор после RetryAfter (429), остальные ошибки — в лог."""
+    async with _send_sem:
+        for attempt in range(SEND_RETRIES + 1):
             try:
-                await app.bot.send_message(chat_id=chat_id, text=text, parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
+                await send()
+                return
+            except RetryAfter as e:
+                # 429 от Telegram: ждём сколько сказали и пробуем снова
+                if attempt == SEND_RETRIES:
+                    log.warning("send to %s failed: %s", chat_id, e)
+                    return
+                delay = e.retry_after  # int или timedelta — зависит от версии PTB
+                await asyncio.sleep(delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay))
             except Exception as e:
-                log.warning(f"send to {chat_id} failed: {e}")
+                log.warning("send to %s failed: %s", chat_id, e)
+                return
+
+# параметры всех сообщений рассылки — в одном месте
+BROADCAST_KW = {"parse_mode": constants.ParseMode.HTML, "disable_web_page_preview": True}
+
+async def send_all(app: Application, text_by_user: Dict[int, str]):
+    bot = app.bot
+    targets = [(cid, text) for cid, text in text_by_user.items() if text.strip()]
+    # _deliver сам логирует ошибки отправки; неожиданное исключение одной доставки не отменяет остальные
+    results = await asyncio.gather(
+        *(_deliver(cid, functools.partial(bot.send_message, chat_id=cid, text=text, **BROADCAST_KW)) for cid, text in targets),
+        return_exceptions=True,
+    )
+    for (cid, _), res in zip(targets, results):
+        if isinstance(res, Exception):
+            log.error("broadcast to %s failed: %s", cid, res)
+
+class OutQueue:
+    """chat_id -> части сообщений; части одного пользователя уходят одним сообщением.
+    Отправка — фоновой задачей (опрос не ждёт Telegram); что пришло во время отправки, уходит следующим заходом."""
+
+    def __init__(self):
+        self._parts: Dict[int, List[str]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def push(self, chat_id: int, text: str):
+        self._parts.setdefault(chat_id, []).append(text)
+
+    def flush_later(self, app: Application):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._drain(app))
+
+    async def _drain(self, app: Application):
+        # задача «жива», пока очередь не пуста: новый flush_later во время отправки ничего не заводит,
+        # поэтому части, добавленные за это время, досылаем здесь же
+        while self._parts:
+            try:
+                await self.flush(app)
+            except Exception:
+                log.exception("broadcast flush failed")
+
+    async def flush(self, app: Application):
+        parts, self._parts = self._parts, {}
+        if parts:
+            await send_all(app, {cid: "\n\n".join(p) for cid, p in parts.items()})
+
+OUT_QUEUE = OutQueue()
+
+def log_row_count() -> int:
+    """Число заполненных строк лога (с заголовком) — по одной колонке A, без чтения всего листа."""
+    return max(len(sh.values_get(f"{LOG_SHEET}!A:A").get("values", [])), 1)
+
+class LogRow(NamedTuple):
+    """Строка лога: только колонки, которые берёт опрос (имена = заголовки листа)."""
+    Event: Any = ""
+    Signal_ID: Any = ""
+    Pair: Any = ""
+    Cum_Margin_USDT: Any = ""
+    PNL_Realized_USDT: Any = ""
+
+LOG_FIELDS = LogRow._fields
+
+def log_records(last_row: int) -> Tuple[int, Iterator[LogRow]]:
+    """Строки лога после last_row (номер последней обработанной строки листа): только колонки LOG_FIELDS.
+    Один values.batchGet: строка заголовка + открытые диапазоны колонок ("E7:E"); нет новых строк — пустой ответ.
+    Возвращает (число строк, генератор LogRow) — записи собираются по одной при обходе."""
+    for attempt in range(2):
+        headers = _headers(LOG_SHEET)
+        fields = [h for h in LOG_FIELDS if h in headers]
+        if not fields:
+            return 0, iter(())
+        ranges = [f"{LOG_SHEET}!1:1"]
+        for h in fields:
+            col = rowcol_to_a1(1, headers.index(h) + 1)[:-1]  # "E1" -> "E"
+            # диапазон начинаем с last_row: эта строка в сетке есть всегда (с last_row+1 на полностью
+            # заполненном листе вышли бы за границу сетки), её значение отбрасываем
+            ranges.append(f"{LOG_SHEET}!{col}{last_row}:{col}")
+        resp = sh.values_batch_get(ranges, params={**READ_PARAMS, "majorDimension": "COLUMNS"})
+        vrs = resp.get("valueRanges", [])
+        # лог ведёт другой бот: колонку могли вставить/переставить — сверяем заголовок с кэшем
+        head = tuple(to_text(c[0]) if c else "" for c in (vrs[0].get("values") or [])) if vrs else ()
+        if head == tuple(to_text(h) for h in headers):
+            break
+        log.warning("%s header changed, re-reading", LOG_SHEET)
+        _headers.cache_clear()
+    else:
+        return 0, iter(())  # заголовок меняется прямо сейчас — попробуем на следующем опросе
+    got = dict(zip(fields, ((vr.get("values") or [[]])[0][1:] for vr in vrs[1:])))
+    cols = [got.get(h, ()) for h in LOG_FIELDS]  # нет колонки в листе — поле пустое
+    n = max(map(len, cols), default=0)  # пустой хвост API обрезает по каждой колонке
+    return n, (LogRow._make(col[i] if i < len(col) else "" for col in cols) for i in range(n))
+
+STATE_TTL = 60.0
+ADD_EVENTS = frozenset({"ADD", "RETEST_ADD"})
+CLOSE_EVENTS = frozenset({"TP_HIT", "SL_HIT", "MANUAL_CLOSE"})
+
+def poll_log() -> Dict[int, List[str]]:
+    """Синхронная часть опроса (в пуле потоков): новые строки лога -> начисления в Users/State; возвращает тексты по chat_id."""
+    # State пишет только бот (кэш правится на месте) — перечитываем его раз в STATE_TTL
+    sheet_cache.load_stale([STATE_SHEET], STATE_TTL)
+    last_row, start_utc, profit30_total = get_state()
+    if last_row == 0:
+        # первый запуск — пропускаем историю
+        set_state(last_row=log_row_count(), profit30_total=0.0, start_utc=start_utc or now_utc_str())
+        return {}
+    n_new, new_records = log_records(last_row)
+    if not n_new:
+        return {}
+    total_rows = last_row + n_new
+    sheet_cache.load([USERS_SHEET])  # есть события — считаем по свежему листу пользователей
+    # Весь опрос считаем на копиях (пользователи, открытые позиции) и пишем одним values.batchUpdate в конце;
+    # кэши и open_positions меняем только после успешной записи — иначе следующий опрос повторит те же строки
+    users = {u.chat_id: u for u in get_users()}
+    positions = dict(open_positions)
+    changes: Dict[int, Dict[str, Any]] = {}  # chat_id -> поля для записи в Users
+    per_user_msgs: Dict[int, List[str]] = {}
+    def push(uid: int, text: str):
+        per_user_msgs.setdefault(uid, []).append(text)
+
+    for rec in new_records:
+        ev = to_text(rec.Event)
+        sid = to_text(rec.Signal_ID)
+        cum_margin = to_float(rec.Cum_Margin_USDT)
+        pnl_usd = to_float(rec.PNL_Realized_USDT)
+        pair = to_text(rec.Pair)
+
+        # Применяем pending депозиты при OPEN (для активных)
+        if ev == "OPEN":
+            # все pending -> deposit
+            for u in users.values():
+                if u.active and u.pending > 0:
+                    u.deposit, u.pending = u.pending, 0.0
+                    changes.setdefault(u.chat_id, {}).update(deposit=u.deposit, pending=0.0)
+            # snapshot активных пользователей (с их депозитами на момент открытия)
+            recipients = [u for u in users.values() if u.active and u.deposit > 0]
+            positions[sid] = OpenPosition(cum_margin, [(u.chat_id, u.deposit) for u in recipients], time.time())
+            used_pct = 100.0 * (cum_margin / max(SYSTEM_BANK_USDT, 1e-9))
+            msg = (
+                f"📊 Сделка открыта по <b>{base_from_pair(pair)}</b>. "
+                f"Задействовано {used_pct:.1f}% банка (≈ ${fmt_usd(cum_margin)})."
+            )
+            for u in recipients:
+                push(u.chat_id, msg)
+
+        elif ev in ADD_EVENTS:
+            snap = positions.get(sid)
+            # правим копию: позиция из open_positions не должна меняться до записи опроса
+            snap = dataclasses.replace(snap) if snap else OpenPosition(0.0, [], time.time())
+            positions[sid] = snap
+            snap.cum_margin = cum_margin
+            if not snap.snapshot:
+                # fallback — если вдруг потеряли snapshot
+                recipients = [u for u in users.values() if u.active and u.deposit > 0]
+                snap.snapshot = [(u.chat_id, u.deposit) for u in recipients]
+            used_pct = 100.0 * (cum_margin / max(SYSTEM_BANK_USDT, 1e-9))
+            msg = f"🪙💵 Добор {base_from_pair(pair)}. Объём в сделке: {used_pct:.1f}% банка (≈ ${fmt_usd(cum_margin)})."
+            for uid in snap.users:
+                push(uid, msg)
+
+        elif ev in CLOSE_EVENTS:
+            snap = positions.pop(sid, None)  # сделка закрыта — позиция больше не нужна
+            cm = snap.cum_margin if snap else cum_margin
+            snapshot = snap.snapshot if snap else []
+            if not snapshot:
+                # если нет — считаем всех активных на сейчас, без распределения по истории (редкий случай)
+                recipients = [u for u in users.values() if u.active and u.deposit > 0]
+                snapshot = [(u.chat_id, u.deposit) for u in recipients]
+            # 30%-модель
+            pool30 = pnl_usd * 0.30
+            profit30_total += pool30  # в State хранится сумма к выплате (30% от PnL)
+            # распределение по депо на момент OPEN
+            total_dep_snap = sum(dep for _, dep in snapshot) or 1.0
+            used_pct = 100.0 * (cm / max(SYSTEM_BANK_USDT, 1e-9))
+            # относительная доходность на сделке (в 30%-м выражении)
+            # исходный profit_pct по марже сделки: pnl_usd / cm * 100
+            profit_pct_raw = (pnl_usd / cm * 100.0) if cm > 0 else 0.0
+            profit_pct_30 = profit_pct_raw * 0.30
+
+            # Разошлём и начислим
+            share_k = pool30 / total_dep_snap  # премия на $1 депозита
+            days = days_since(start_utc)       # одна дата старта на всех
+            # общая для всех часть текста (знак премии у всех совпадает со знаком пула)
+            head = (
+                f"{'🚀' if pool30 >= 0 else '🛑'} Сделка закрыта по <b>{base_from_pair(pair)}</b>.\n"
+                f"Использовалось {used_pct:.1f}% банка (≈ ${fmt_usd(cm)}).\n"
+                f"P&L (30% пул): <b>${fmt_usd(pool30)}</b> ({profit_pct_30:+.2f}%)\n"
+            )
+            for (uid, dep_snap) in snapshot:
+                u = users.get(uid)
+                if not u:  # пользователь уже удалён
+                    continue
+                my_bonus = dep_snap * share_k
+                # начислим премию пользователю (копия уже учитывает прошлые закрытия этого опроса)
+                u.bonus_acc += my_bonus
+                changes.setdefault(uid, {})["bonus_acc"] = u.bonus_acc
+                # текст
+                ann_pct, ann_usd = annual_forecast(
+                    user_bonus_total=u.bonus_acc,  # после начисления
+                    start_utc=start_utc,
+                    user_deposit=u.deposit,  # текущий депозит (Ок для оценки)
+                    days=days,
+                )
+                txt = head + (
+                    f"Ваша премия за сделку: <b>${fmt_usd(my_bonus)}</b>\n\n"
+                    f"Оценка годовых для вашего депозита (${fmt_usd(u.deposit)}): "
+                    f"~{ann_pct:.1f}% (≈ ${fmt_usd(ann_usd)}/год)."
+                )
+                push(uid, txt)
+
+    # Начисления, pending->deposit и State (курсор, сумма, открытые позиции) — одним values.batchUpdate:
+    # запрос применяется целиком или никак, так что курсор не разойдётся с начислениями и повторный
+    # опрос не начислит премию дважды. Позиции в State — чтобы CLOSE после рестарта делился по снимку с OPEN.
+    sweep_open_positions(positions)
+    now = now_utc_str()
+    users_data, applied = users_batch_data(changes, now)
+    state_data, state_row = state_batch_data(
+        last_row=total_rows, profit30_total=profit30_total, positions_json=dump_open_positions(positions),
+    )
+    if users_data or state_data:
+        sh.values_batch_update(body={"valueInputOption": "RAW", "data": users_data + state_data})
+    # запись прошла — теперь кэши и позиции
+    apply_users_changes(applied, now)
+    sheet_cache.put_row(STATE_SHEET, 0, state_row)
+    open_positions.clear()
+    open_positions.update(positions)
+    return per_user_msgs
 
 async def poll_and_broadcast(app: Application):
     try:
-        last_row, start_utc, profit30_total = get_state()
-        recs = sheet_dicts(ws(LOG_SHEET))
-        total_rows = len(recs) + 1
-        if last_row == 0:
-            # первый запуск — пропускаем историю
-            set_state(last_row=total_rows, profit30_total=0.0, start_utc=start_utc or now_utc_str())
-            return
-        if total_rows <= last_row:
-            return
-        new_records = recs[(last_row - 1):]
-        users_all = get_users()
-        per_user_msgs: Dict[int, List[str]] = {}
-        def push(uid: int, text: str):
-            per_user_msgs.setdefault(uid, []).append(text)
-
-        for rec in new_records:
-            ev = (rec.get("Event") or "").strip()
-            sid = (rec.get("Signal_ID") or "").strip()
-            cum_margin = to_float(rec.get("Cum_Margin_USDT"))
-            pnl_usd = to_float(rec.get("PNL_Realized_USDT"))
-            pair = rec.get("Pair", "")
-
-            # Применяем pending депозиты при OPEN (для активных)
-            if ev == "OPEN":
-                users_all = get_users()  # свежий снимок
-                for u in users_all:
-                    if u["active"] and u["pending"] > 0:
-                        upsert_user_row(u["chat_id"], deposit=u["pending"], pending=0.0)
-                        u["deposit"], u["pending"] = u["pending"], 0.0
-                # snapshot активных пользователей (с их депозитами на момент открытия)
-                recipients = [u for u in users_all if u["active"] and u["deposit"] > 0]
-                open_positions[sid] = {
-                    "cum_margin": cum_margin,
-                    "snapshot": [(u["chat_id"], u["deposit"]) for u in recipients],
-                    "users": [u["chat_id"] for u in recipients]
-                }
-                used_pct = 100.0 * (cum_margin / max(SYSTEM_BANK_USDT, 1e-9))
-                msg = (
-                    f"📊 Сделка открыта по <b>{base_from_pair(pair)}</b>. "
-                    f"Задействовано {used_pct:.1f}% банка (≈ ${fmt_usd(cum_margin)})."
-                )
-                for u in recipients:
-                    push(u["chat_id"], msg)
-
-            elif ev in ("ADD","RETEST_ADD"):
-                snap = open_positions.setdefault(sid, {"cum_margin": 0.0, "snapshot": [], "users": []})
-                snap["cum_margin"] = cum_margin
-                if not snap.get("users"):
-                    # fallback — если вдруг потеряли snapshot
-                    recipients = [u for u in users_all if u["active"] and u["deposit"] > 0]
-                    snap["users"] = [u["chat_id"] for u in recipients]
-                    snap["snapshot"] = [(u["chat_id"], u["deposit"]) for u in recipients]
-                used_pct = 100.0 * (cum_margin / max(SYSTEM_BANK_USDT, 1e-9))
-                msg = f"🪙💵 Добор {base_from_pair(pair)}. Объём в сделке: {used_pct:.1f}% банка (≈ ${fmt_usd(cum_margin)})."
-                for uid in snap["users"]:
-                    push(uid, msg)
-
-            elif ev in ("TP_HIT","SL_HIT","MANUAL_CLOSE"):
-                snap = open_positions.get(sid, {})
-                cm = snap.get("cum_margin", cum_margin)
-                recipients_ids = snap.get("users", [])
-                snapshot = snap.get("snapshot", [])
-                if not recipients_ids:
-                    # если нет — считаем всех активных на сейчас, без распределения по истории (редкий случай)
-                    users_all = get_users()
-                    recipients = [u for u in users_all if u["active"] and u["deposit"] > 0]
-                    recipients_ids = [u["chat_id"] for u in recipients]
-                    snapshot = [(u["chat_id"], u["deposit"]) for u in recipients]
-                # 30%-модель
-                pool30 = pnl_usd * 0.30
-                profit30_total += pool30  # в State хранится сумма к выплате (30% от PnL)
-                # распределение по депо на момент OPEN
-                total_dep_snap = sum(dep for _, dep in snapshot) or 1.0
-                used_pct = 100.0 * (cm / max(SYSTEM_BANK_USDT, 1e-9))
-                # относительная доходность на сделке (в 30%-м выражении)
-                # исходный profit_pct по марже сделки: pnl_usd / cm * 100
-                profit_pct_raw = (pnl_usd / cm * 100.0) if cm > 0 else 0.0
-                profit_pct_30 = profit_pct_raw * 0.30
-
-                # Разошлём и начислим
-                for (uid, dep_snap) in snapshot:
-                    u = next((x for x in get_users() if x["chat_id"] == uid), None)
-                    if not u:  # пользователь уже удалён
-                        continue
-                    my_bonus = pool30 * (dep_snap / total_dep_snap)
-                    # начислим премию пользователю
-                    upsert_user_row(uid, bonus_acc=u["bonus_acc"] + my_bonus)
-                    # текст
-                    ann_pct, ann_usd = annual_forecast(
-                        user_bonus_total=(u["bonus_acc"] + my_bonus),  # после начисления
-                        start_utc=start_utc,
-                        user_deposit=u["deposit"]  # текущий депозит (Ок для оценки)
-                    )
-                    icon = "🚀" if my_bonus >= 0 else "🛑"
-                    txt = (
-                        f"{icon} Сделка закрыта по <b>{base_from_pair(pair)}</b>.\n"
-                        f"Использовалось {used_pct:.1f}% банка (≈ ${fmt_usd(cm)}).\n"
-                        f"P&L (30% пул): <b>${fmt_usd(pool30)}</b> ({profit_pct_30:+.2f}%)\n"
-                        f"Ваша премия за сделку: <b>${fmt_usd(my_bonus)}</b>\n\n"
-                        f"Оценка годовых для вашего депозита (${fmt_usd(u['deposit'])}): "
-                        f"~{ann_pct:.1f}% (≈ ${fmt_usd(ann_usd)}/год)."
-                    )
-                    push(uid, txt)
-                # очистим
-                if sid in open_positions:
-                    del open_positions[sid]
-
-        # отправим накопленные сообщения
+        per_user_msgs = await sh_run(poll_log)
+        # в очередь: сообщения одному пользователю склеятся и уйдут фоновой задачей
+        for uid, msgs in per_user_msgs.items():
+            for m in msgs:
+                OUT_QUEUE.push(uid, m)
         if per_user_msgs:
-            await send_all(app, {uid: "\n\n".join(msgs) for uid, msgs in per_user_msgs.items()})
-        set_state(last_row=total_rows, profit30_total=profit30_total)
+            OUT_QUEUE.flush_later(app)
     except Exception as e:
         log.exception("poll_and_broadcast error")
 
@@ -1021,21 +1435,60 @@ async def poll_job(context: ContextTypes.DEFAULT_TYPE):
 
 # ------------------- post_init & main -------------------
 async def post_init(app: Application):
-    await set_menu_default(app)
-    await set_menu_admins(app)
-    # восстановим меню юзерам
+    # проверка/создание листов идёт в пуле потоков одновременно с настройкой меню (до старта опроса)
+    await asyncio.gather(set_menu_default(app), set_menu_admins(app), sh_run(ensure_sheets))
+    # восстановим меню юзерам — параллельно, под тем же семафором, что и рассылка
+    async def _restore(u: User):
+        async with _send_sem:
+            try:
+                await set_menu_user(app, int(u.chat_id))
+            except Exception as e:
+                log.warning("set_menu_user failed for %s: %s", u, e)
+    try:
+        await asyncio.gather(*(_restore(u) for u in await sh_run(get_users) if u.active))
+    except Exception as e:
+        log.warning("post_init restore menus failed: %s", e)
+    # заголовок лога читаем один раз на старте, опрос берёт его из кэша
     try:
-        for u in get_users():
-            if u.get("active"):
-                try:
-                    await set_menu_user(app, int(u["chat_id"]))
-                except Exception as e:
-                    log.warning(f"set_menu_user failed for {u}: {e}")
+        await sh_run(_headers, LOG_SHEET, locked=False)
     except Exception as e:
-        log.warning(f"post_init restore menus failed: {e}")
+        log.warning("post_init log header read failed: %s", e)
+    await sh_run(load_open_positions)
+    app.bot_data["ledger_task"] = asyncio.create_task(ledger_flusher())
+
+async def post_stop(app: Application):
+    try:
+        await OUT_QUEUE.flush(app)  # бот ещё жив — дошлём хвост очереди
+    except Exception:
+        log.exception("final broadcast flush failed")
+
+async def post_shutdown(app: Application):
+    task = app.bot_data.pop("ledger_task", None)
+    if task:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    SHEET_EXEC.shutdown(wait=True)  # дождёмся записей, уже ушедших в пул
+    try:
+        flush_ledger()
+    except Exception:
+        log.exception("final ledger flush failed")
 
 def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).build()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", force=True)
+    log.info("ADMIN_IDS parsed=%s", sorted(ADMIN_IDS))
+    app = (
+        ApplicationBuilder().token(BOT_TOKEN)
+        .request(HTTPXRequest(connection_pool_size=32, pool_timeout=10.0, http_version="2"))
+        .get_updates_request(HTTPXRequest(connection_pool_size=4))
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     # user
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("about", about))
@@ -1063,8 +1516,19 @@ def main():
 
     # poller
     app.job_queue.run_repeating(poll_job, interval=10, first=5)
-    log.info(f"{BOT_NAME} starting…")
-    app.run_polling()
+    log.info("%s starting…", BOT_NAME)
+    if WEBHOOK_URL:
+        # путь — хэш токена (сам токен в URL не светим), входящие проверяются по secret_token
+        path = hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+        app.run_webhook(
+            listen="0.0.0.0", port=WEBHOOK_PORT, url_path=path,
+            webhook_url=f"{WEBHOOK_URL}/{path}", secret_token=WEBHOOK_SECRET,
+            allowed_updates=[Update.MESSAGE], drop_pending_updates=False,
+        )
+        return
+    # long-poll 30 s, только сообщения; offset подтверждает сам Telegram — после рестарта
+    # необработанные апдейты не теряются (drop_pending_updates=False)
+    app.run_polling(timeout=30, allowed_updates=[Update.MESSAGE], drop_pending_updates=False)
 
 if __name__ == "__main__":
     main()